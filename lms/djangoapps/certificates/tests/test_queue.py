@@ -2,18 +2,16 @@
 
 
 import json
-from contextlib import contextmanager
+from contextlib import ExitStack, contextmanager
 from datetime import datetime, timedelta
-from unittest.mock import Mock, patch
+from unittest.mock import patch
 
 import ddt
-import freezegun
 import pytz
 from django.conf import settings
 from django.test import TestCase
 from django.test.utils import override_settings
 from opaque_keys.edx.locator import CourseLocator
-from testfixtures import LogCapture
 
 # It is really unfortunate that we are using the XQueue client
 # code from the capa library.  In the future, we should move this
@@ -23,7 +21,8 @@ from testfixtures import LogCapture
 from capa.xqueue_interface import XQueueInterface
 from common.djangoapps.course_modes import api as modes_api
 from common.djangoapps.course_modes.models import CourseMode
-from common.djangoapps.student.tests.factories import CourseEnrollmentFactory, UserFactory
+from common.djangoapps.student.models import CourseEnrollment
+from common.djangoapps.student.tests.factories import UserFactory
 from lms.djangoapps.certificates.models import (
     CertificateStatuses,
     ExampleCertificate,
@@ -31,65 +30,87 @@ from lms.djangoapps.certificates.models import (
     GeneratedCertificate
 )
 from lms.djangoapps.certificates.queue import LOGGER, XQueueCertInterface
-from lms.djangoapps.certificates.tests.factories import CertificateAllowlistFactory, GeneratedCertificateFactory
+from lms.djangoapps.certificates.tests.factories import CertificateAllowlistFactory
 from lms.djangoapps.grades.tests.utils import mock_passing_grade
-from lms.djangoapps.verify_student.tests.factories import SoftwareSecurePhotoVerificationFactory
-from xmodule.modulestore.tests.django_utils import ModuleStoreTestCase
-from xmodule.modulestore.tests.factories import CourseFactory
+from lms.djangoapps.verify_student.models import SoftwareSecurePhotoVerification
+from openedx.core.djangoapps.content.course_overviews.tests.factories import CourseOverviewFactory
+from openedx.core.djangolib.testing.utils import CacheIsolationTestCase
+
+# Reference time for the audit certificate cutoff and backdated certificates
+_TEST_NOW = datetime.now(pytz.UTC)
+
+
+@contextmanager
+def mocked_send(return_value=(0, None)):
+    """Mock the XQueue method for sending a task to the queue. """
+    with patch.object(XQueueInterface, 'send_to_queue', return_value=return_value) as mock_send:
+        yield mock_send
 
 
 @ddt.ddt
 @override_settings(CERT_QUEUE='certificates')
-class XQueueCertInterfaceAddCertificateTest(ModuleStoreTestCase):
+class XQueueCertInterfaceAddCertificateTest(CacheIsolationTestCase):
     """Test the "add to queue" operation of the XQueue interface. """
 
-    def setUp(self):
-        super().setUp()
-        self.user = UserFactory.create()
-        self.course = CourseFactory.create()
-        self.enrollment = CourseEnrollmentFactory(
-            user=self.user,
-            course_id=self.course.id,
+    COURSE_KEY = CourseLocator(org='test', course='test', run='test')
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # `send_to_queue` is always mocked, so one interface can serve every test
+        cls.xqueue = XQueueCertInterface()
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        CourseOverviewFactory.create(id=cls.COURSE_KEY)
+        cls.user = UserFactory.create()
+        cls.enrollment = CourseEnrollment.objects.create(
+            user=cls.user,
+            course_id=cls.COURSE_KEY,
             is_active=True,
             mode="honor",
         )
-        self.xqueue = XQueueCertInterface()
-        self.user_2 = UserFactory.create()
-        SoftwareSecurePhotoVerificationFactory.create(user=self.user_2, status='approved')
+        cls.user_2 = UserFactory.create()
+        SoftwareSecurePhotoVerification.objects.create(user=cls.user_2, status='approved')
 
-    def test_add_cert_callback_url(self):
+    def setUp(self):
+        super().setUp()
 
-        with mock_passing_grade():
-            with patch.object(XQueueInterface, 'send_to_queue') as mock_send:
-                mock_send.return_value = (0, None)
-                self.xqueue.add_cert(self.user, self.course.id)
+        # Every test runs with a passing grade and a successful XQueue submission.
+        # Tests that need something else can nest their own patches or change
+        # `self.mock_send.return_value`.
+        stack = ExitStack()
+        self.addCleanup(stack.close)
+        stack.enter_context(mock_passing_grade())
+        self.mock_send = stack.enter_context(mocked_send())
+
+    def test_add_cert_callback_url(self):
+        self.xqueue.add_cert(self.user, self.COURSE_KEY)
 
         # Verify that the task was sent to the queue with the correct callback URL
-        assert mock_send.called
-        __, kwargs = mock_send.call_args_list[0]
-        actual_header = json.loads(kwargs['header'])
-        assert 'https://edx.org/update_certificate?key=' in actual_header['lms_callback_url']
+        assert self.mock_send.called
+        __, kwargs = self.mock_send.call_args_list[0]
+        assert 'https://edx.org/update_certificate?key=' in kwargs['header']
 
     def test_no_create_action_in_queue_for_html_view_certs(self):
         """
         Tests there is no certificate create message in the queue if generate_pdf is False
         """
-        with mock_passing_grade():
-            with patch.object(XQueueInterface, 'send_to_queue') as mock_send:
-                self.xqueue.add_cert(self.user, self.course.id, generate_pdf=False)
+        self.xqueue.add_cert(self.user, self.COURSE_KEY, generate_pdf=False)
 
         # Verify that add_cert method does not add message to queue
-        assert not mock_send.called
-        certificate = GeneratedCertificate.eligible_certificates.get(user=self.user, course_id=self.course.id)
+        assert not self.mock_send.called
+        certificate = GeneratedCertificate.eligible_certificates.get(user=self.user, course_id=self.COURSE_KEY)
         assert certificate.status == CertificateStatuses.downloadable
         assert certificate.verify_uuid is not None
 
     @ddt.data('honor', 'audit')
-    @override_settings(AUDIT_CERT_CUTOFF_DATE=datetime.now(pytz.UTC) - timedelta(days=1))
+    @override_settings(AUDIT_CERT_CUTOFF_DATE=_TEST_NOW - timedelta(days=1))
     def test_add_cert_with_honor_certificates(self, mode):
         """Test certificates generations for honor and audit modes."""
         template_name = 'certificate-template-{id.org}-{id.course}.pdf'.format(
-            id=self.course.id
+            id=self.COURSE_KEY
         )
         mock_send = self.add_cert_to_queue(mode)
         if modes_api.is_eligible_for_certificate(mode):
@@ -103,7 +124,7 @@ class XQueueCertInterfaceAddCertificateTest(ModuleStoreTestCase):
         software-secure verification than verified certificate should be generated.
         """
         template_name = 'certificate-template-{id.org}-{id.course}-verified.pdf'.format(
-            id=self.course.id
+            id=self.COURSE_KEY
         )
 
         mock_send = self.add_cert_to_queue(mode)
@@ -111,30 +132,27 @@ class XQueueCertInterfaceAddCertificateTest(ModuleStoreTestCase):
 
     @ddt.data((True, CertificateStatuses.audit_passing), (False, CertificateStatuses.generating))
     @ddt.unpack
-    @override_settings(AUDIT_CERT_CUTOFF_DATE=datetime.now(pytz.UTC) - timedelta(days=1))
+    @override_settings(AUDIT_CERT_CUTOFF_DATE=_TEST_NOW - timedelta(days=1))
     def test_ineligible_cert_whitelisted(self, disable_audit_cert, status):
         """
         Test that audit mode students receive a certificate if DISABLE_AUDIT_CERTIFICATES
         feature is set to false
         """
         # Enroll as audit
-        CourseEnrollmentFactory(
+        CourseEnrollment.objects.create(
             user=self.user_2,
-            course_id=self.course.id,
+            course_id=self.COURSE_KEY,
             is_active=True,
             mode='audit'
         )
         # Whitelist student
-        CertificateAllowlistFactory(course_id=self.course.id, user=self.user_2)
+        CertificateAllowlistFactory(course_id=self.COURSE_KEY, user=self.user_2)
 
-        features = settings.FEATURES
-        features['DISABLE_AUDIT_CERTIFICATES'] = disable_audit_cert
-        with override_settings(FEATURES=features) and mock_passing_grade():
-            with patch.object(XQueueInterface, 'send_to_queue') as mock_send:
-                mock_send.return_value = (0, None)
-                self.xqueue.add_cert(self.user_2, self.course.id)
+        features = {**settings.FEATURES, 'DISABLE_AUDIT_CERTIFICATES': disable_audit_cert}
+        with override_settings(FEATURES=features):
+            self.xqueue.add_cert(self.user_2, self.COURSE_KEY)
 
-        certificate = GeneratedCertificate.certificate_for_student(self.user_2, self.course.id)
+        certificate = GeneratedCertificate.certificate_for_student(self.user_2, self.COURSE_KEY)
         assert certificate is not None
         assert certificate.mode == 'audit'
         assert certificate.status == status
@@ -146,17 +164,14 @@ class XQueueCertInterfaceAddCertificateTest(ModuleStoreTestCase):
         `XQueueInterface.send_to_queue` method, which can be used in other
         assertions.
         """
-        CourseEnrollmentFactory(
+        CourseEnrollment.objects.create(
             user=self.user_2,
-            course_id=self.course.id,
+            course_id=self.COURSE_KEY,
             is_active=True,
             mode=mode,
         )
-        with mock_passing_grade():
-            with patch.object(XQueueInterface, 'send_to_queue') as mock_send:
-                mock_send.return_value = (0, None)
-                self.xqueue.add_cert(self.user_2, self.course.id)
-                return mock_send
+        self.xqueue.add_cert(self.user_2, self.COURSE_KEY)
+        return self.mock_send
 
     def assert_certificate_generated(self, mock_send, expected_mode, expected_template_name):
         """
@@ -166,14 +181,12 @@ class XQueueCertInterfaceAddCertificateTest(ModuleStoreTestCase):
         # Verify that the task was sent to the queue with the correct callback URL
         assert mock_send.called
         __, kwargs = mock_send.call_args_list[0]
-
-        actual_header = json.loads(kwargs['header'])
-        assert 'https://edx.org/update_certificate?key=' in actual_header['lms_callback_url']
+        assert 'https://edx.org/update_certificate?key=' in kwargs['header']
 
         body = json.loads(kwargs['body'])
         assert expected_template_name in body['template_pdf']
 
-        certificate = GeneratedCertificate.eligible_certificates.get(user=self.user_2, course_id=self.course.id)
+        certificate = GeneratedCertificate.eligible_certificates.get(user=self.user_2, course_id=self.COURSE_KEY)
         assert certificate.mode == expected_mode
 
     def assert_ineligible_certificate_generated(self, mock_send, expected_mode):
@@ -186,7 +199,7 @@ class XQueueCertInterfaceAddCertificateTest(ModuleStoreTestCase):
 
         certificate = GeneratedCertificate.objects.get(
             user=self.user_2,
-            course_id=self.course.id
+            course_id=self.COURSE_KEY
         )
 
         assert certificate.status in (CertificateStatuses.audit_passing, CertificateStatuses.audit_notpassing)
@@ -211,7 +224,7 @@ class XQueueCertInterfaceAddCertificateTest(ModuleStoreTestCase):
         """
         with patch(
             'lms.djangoapps.certificates.queue.certificate_status_for_student',
-            Mock(return_value={'status': status})
+            new=lambda *args, **kwargs: {'status': status},
         ):
             mock_send = self.add_cert_to_queue('verified')
             if should_generate:
@@ -257,36 +270,35 @@ class XQueueCertInterfaceAddCertificateTest(ModuleStoreTestCase):
         ),
     )
     @ddt.unpack
-    @override_settings(AUDIT_CERT_CUTOFF_DATE=datetime.now(pytz.UTC) - timedelta(days=1))
+    @override_settings(AUDIT_CERT_CUTOFF_DATE=_TEST_NOW - timedelta(days=1))
     def test_regen_audit_certs_eligibility(self, status, created_delta, grade, expected_status):
         """
         Test that existing audit certificates remain eligible even if cert
         generation is re-run.
         """
         # Create an existing audit enrollment and certificate
-        CourseEnrollmentFactory(
+        CourseEnrollment.objects.create(
             user=self.user_2,
-            course_id=self.course.id,
+            course_id=self.COURSE_KEY,
             is_active=True,
             mode=CourseMode.AUDIT,
         )
-        created_date = datetime.now(pytz.UTC) + created_delta
-        with freezegun.freeze_time(created_date):
-            GeneratedCertificateFactory(
-                user=self.user_2,
-                course_id=self.course.id,
-                grade='1.0',
-                status=status,
-                mode=GeneratedCertificate.MODES.audit,
-            )
+        cert = GeneratedCertificate.objects.create(
+            user=self.user_2,
+            course_id=self.COURSE_KEY,
+            grade='1.0',
+            status=status,
+            mode=GeneratedCertificate.MODES.audit,
+        )
+        # `created_date` is auto_now_add, so backdate it with an update query
+        created_date = _TEST_NOW + created_delta
+        GeneratedCertificate.objects.filter(pk=cert.pk).update(created_date=created_date)
 
         # Run grading/cert generation again
         with mock_passing_grade(letter_grade=grade):
-            with patch.object(XQueueInterface, 'send_to_queue') as mock_send:
-                mock_send.return_value = (0, None)
-                self.xqueue.add_cert(self.user_2, self.course.id)
+            self.xqueue.add_cert(self.user_2, self.COURSE_KEY)
 
-        assert GeneratedCertificate.objects.get(user=self.user_2, course_id=self.course.id).status == expected_status
+        assert GeneratedCertificate.objects.get(user=self.user_2, course_id=self.COURSE_KEY).status == expected_status
 
     def test_regen_cert_with_pdf_certificate(self):
         """
@@ -295,15 +307,15 @@ class XQueueCertInterfaceAddCertificateTest(ModuleStoreTestCase):
         """
         download_url = 'http://www.example.com/certificate.pdf'
         # Create an existing verified enrollment and certificate
-        CourseEnrollmentFactory(
+        CourseEnrollment.objects.create(
             user=self.user_2,
-            course_id=self.course.id,
+            course_id=self.COURSE_KEY,
             is_active=True,
             mode=CourseMode.VERIFIED,
         )
-        GeneratedCertificateFactory(
+        GeneratedCertificate.objects.create(
             user=self.user_2,
-            course_id=self.course.id,
+            course_id=self.COURSE_KEY,
             grade='1.0',
             status=CertificateStatuses.downloadable,
             mode=GeneratedCertificate.MODES.verified,
@@ -319,15 +331,15 @@ class XQueueCertInterfaceAddCertificateTest(ModuleStoreTestCase):
         """
         download_url = 'http://www.example.com/certificate.pdf'
         # Create an existing verified enrollment and certificate
-        CourseEnrollmentFactory(
+        CourseEnrollment.objects.create(
             user=self.user_2,
-            course_id=self.course.id,
+            course_id=self.COURSE_KEY,
             is_active=True,
             mode=CourseMode.VERIFIED,
         )
-        GeneratedCertificateFactory(
+        GeneratedCertificate.objects.create(
             user=self.user_2,
-            course_id=self.course.id,
+            course_id=self.COURSE_KEY,
             grade='1.0',
             status=CertificateStatuses.downloadable,
             mode=GeneratedCertificate.MODES.verified,
@@ -338,29 +350,24 @@ class XQueueCertInterfaceAddCertificateTest(ModuleStoreTestCase):
 
     def _assert_pdf_cert_generation_discontinued_logs(self, download_url, add_cert=False):
         """Assert PDF certificate generation discontinued logs."""
-        with LogCapture(LOGGER.name) as log:
+        with self.assertLogs(LOGGER.name, level='WARNING') as log_ctx:
             if add_cert:
-                self.xqueue.add_cert(self.user_2, self.course.id)
+                self.xqueue.add_cert(self.user_2, self.COURSE_KEY)
             else:
-                self.xqueue.regen_cert(self.user_2, self.course.id)
-            log.check_present(
-                (
-                    LOGGER.name,
-                    'WARNING',
-                    (
-                        "PDF certificate generation discontinued, canceling "
-                        "PDF certificate generation for student {student_id} "
-                        "in course '{course_id}' "
-                        "with status '{status}' "
-                        "and download_url '{download_url}'."
-                    ).format(
-                        student_id=self.user_2.id,
-                        course_id=str(self.course.id),
-                        status=CertificateStatuses.downloadable,
-                        download_url=download_url
-                    )
-                )
-            )
+                self.xqueue.regen_cert(self.user_2, self.COURSE_KEY)
+        expected_message = (
+            "PDF certificate generation discontinued, canceling "
+            "PDF certificate generation for student {student_id} "
+            "in course '{course_id}' "
+            "with status '{status}' "
+            "and download_url '{download_url}'."
+        ).format(
+            student_id=self.user_2.id,
+            course_id=str(self.COURSE_KEY),
+            status=CertificateStatuses.downloadable,
+            download_url=download_url
+        )
+        assert f'WARNING:{LOGGER.name}:{expected_message}' in log_ctx.output
 
 
 @override_settings(CERT_QUEUE='certificates')
@@ -373,13 +380,14 @@ class XQueueCertInterfaceExampleCertificateTest(TestCase):
     DESCRIPTION = 'test'
     ERROR_MSG = 'Kaboom!'
 
-    def setUp(self):
-        super().setUp()
-        self.xqueue = XQueueCertInterface()
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.xqueue = XQueueCertInterface()
 
     def test_add_example_cert(self):
         cert = self._create_example_cert()
-        with self._mock_xqueue() as mock_send:
+        with mocked_send() as mock_send:
             self.xqueue.add_example_cert(cert)
 
         # Verify that the correct payload was sent to the XQueue
@@ -390,7 +398,7 @@ class XQueueCertInterfaceExampleCertificateTest(TestCase):
 
     def test_add_example_cert_error(self):
         cert = self._create_example_cert()
-        with self._mock_xqueue(success=False):
+        with mocked_send(return_value=(1, self.ERROR_MSG)):
             self.xqueue.add_example_cert(cert)
 
         # Verify the error status of the certificate
@@ -406,13 +414,6 @@ class XQueueCertInterfaceExampleCertificateTest(TestCase):
             template=self.TEMPLATE
         )
 
-    @contextmanager
-    def _mock_xqueue(self, success=True):
-        """Mock the XQueue method for sending a task to the queue. """
-        with patch.object(XQueueInterface, 'send_to_queue') as mock_send:
-            mock_send.return_value = (0, None) if success else (1, self.ERROR_MSG)
-            yield mock_send
-
     def _assert_queue_task(self, mock_send, cert):
         """Check that the task was added to the queue. """
         expected_header = {